@@ -1,8 +1,27 @@
 #!/usr/bin/env python
+import atexit
+import concurrent.futures
+import functools
+import hashlib
+import json
+import logging
+import os
+import queue
+import re
+import shelve
+import shutil
 import tempfile
+import threading
+import time
+import zipfile
+from html import escape
+from html import unescape
+from logging.handlers import QueueHandler
+from logging.handlers import QueueListener
 
 import requests
-from bs4 import BeautifulSoup
+from selectolax.lexbor import LexborHTMLParser
+from urllib3.util.retry import Retry
 
 from ricecooker.chefs import SushiChef
 from ricecooker.classes import licenses
@@ -13,8 +32,7 @@ from ricecooker.classes.nodes import TopicNode
 from ricecooker.utils.caching import CacheControlAdapter
 from ricecooker.utils.caching import CacheForeverHeuristic
 from ricecooker.utils.caching import FileCache
-from ricecooker.utils.html import download_file
-from ricecooker.utils.zip import create_predictable_zip
+from ricecooker.utils.html import calculate_relative_url
 
 # CHANNEL SETTINGS
 SOURCE_DOMAIN = "<yourdomain.org>"  #
@@ -22,36 +40,280 @@ SOURCE_ID = "<yourid>"  # an alphanumeric ID refering to this channel
 CHANNEL_TITLE = "<channeltitle>"  # a humand-readbale title
 CHANNEL_LANGUAGE = "en"  # language of channel
 
+# number of subpages to download in parallel
+DOWNLOAD_WORKERS = 16
+# number of images to download in parallel, shared by all the subpages
+IMAGE_DOWNLOAD_WORKERS = 32
+# number of keep-alive connections to hold open per host, shared by all threads
+HTTP_POOL_SIZE = 32
+# size of the chunks in which downloaded files are streamed
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+# files bigger than this are buffered on disk rather than in memory until zipped
+ZIP_SPOOL_MAX_SIZE = 1024 * 1024
+# fixed timestamp given to every file in the zips, so that their MD5 is stable
+ZIP_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+# directory holding the HTTP cache, and the data extracted from pages in earlier runs
+CACHE_DIR = ".webcache"
+# name under which the subpages extracted from list pages are cached; change it
+# whenever the extraction done by get_subpages_from_wikipedia_list changes, so
+# subpages extracted before are discarded
+LISTCACHE_PREFIX = "list-v2"
+# name under which rewritten pages are cached; change it whenever the rewriting
+# done by process_wikipedia_page changes, so pages rewritten before are discarded
+PAGECACHE_PREFIX = "page-v4"
+# how long (in seconds) to remember that a URL was not found, before trying it again
+NOTFOUND_CACHE_TTL = 7 * 24 * 60 * 60
+
+# the download threads only put their log records on a queue, and a listener thread
+# passes them on to the handlers of the "ricecooker" logger (set up by setup_logging),
+# so the threads don't wait on each other to write to the console or log files
+LOGGER = logging.getLogger("wikichef")
+LOGGER.propagate = False
+log_queue = queue.Queue(-1)
+LOGGER.addHandler(QueueHandler(log_queue))
+log_listener = QueueListener(log_queue, logging.getLogger("ricecooker"))
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# a single session is used for every request in the run, so that connections are reused
 sess = requests.Session()
-cache = FileCache(".webcache")
-basic_adapter = CacheControlAdapter(cache=cache)
-forever_adapter = CacheControlAdapter(heuristic=CacheForeverHeuristic(), cache=cache)
+cache = FileCache(CACHE_DIR)
+adapter_kwargs = {
+    "pool_connections": HTTP_POOL_SIZE,
+    "pool_maxsize": HTTP_POOL_SIZE,
+    # with more threads than pooled connections, make threads wait for a pooled
+    # connection rather than open (and handshake) throwaway ones
+    "pool_block": True,
+    "max_retries": Retry(total=3, backoff_factor=0.2),
+}
+basic_adapter = CacheControlAdapter(cache=cache, **adapter_kwargs)
+forever_adapter = CacheControlAdapter(
+    heuristic=CacheForeverHeuristic(), cache=cache, **adapter_kwargs
+)
 
 sess.mount("http://", forever_adapter)
 sess.mount("https://", forever_adapter)
 
+# a single pool of threads downloads the images of all the subpages, so the number of
+# threads stays fixed instead of new ones being started for every subpage
+image_executor = concurrent.futures.ThreadPoolExecutor(
+    max_workers=IMAGE_DOWNLOAD_WORKERS
+)
 
+# matches the src attribute of an <img> tag, capturing the URL in the middle group
+IMG_SRC_RE = re.compile(rb'(<img\b[^>]*?\ssrc=")([^"]+)(")', re.IGNORECASE)
+
+# the FileCache doesn't keep failed responses, so remember URLs that were not found
+# separately, as {url: expiry timestamp}, to avoid requesting them again on every run
+os.makedirs(CACHE_DIR, exist_ok=True)
+notfound_cache = shelve.open(os.path.join(CACHE_DIR, "notfound"))
+notfound_cache_lock = threading.Lock()
+atexit.register(notfound_cache.close)
+
+
+# called for every link and image, and the same URLs (icons, flags) repeat a lot
+@functools.lru_cache(maxsize=8192)
 def make_fully_qualified_url(url):
-    if url.startswith("//"):
+    if url[:2] == "//":
         return "https:" + url
-    if url.startswith("/"):
+    if url[:1] == "/":
         return "https://en.wikipedia.org" + url
     assert url.startswith("http"), "Bad URL (relative to unknown location): " + url
     return url
 
 
 def make_request(url, *args, **kwargs):
+    with notfound_cache_lock:
+        notfound_expiry = notfound_cache.get(url)
+    if notfound_expiry and notfound_expiry > time.time():
+        LOGGER.warning("URL NOT FOUND (CACHED): " + url)
+        return make_notfound_response(url)
+
     response = sess.get(url, *args, **kwargs)
     if response.status_code != 200:
-        print("NOT FOUND:", url)
+        LOGGER.warning("URL NOT FOUND: " + url)
+        if response.status_code == 404:
+            with notfound_cache_lock:
+                notfound_cache[url] = time.time() + NOTFOUND_CACHE_TTL
     elif not response.from_cache:
-        print("NOT CACHED:", url)
+        LOGGER.info("NOT CACHED: " + url)
     return response
 
 
-def get_parsed_html_from_url(url, *args, **kwargs):
-    html = make_request(url, *args, **kwargs).content
-    return BeautifulSoup(html, "html.parser")
+def make_notfound_response(url):
+    """
+    Build an empty 404 response for `url`, for URLs known not to exist.
+    """
+    response = requests.Response()
+    response.status_code = 404
+    response.reason = "Not Found"
+    response.url = url
+    response.from_cache = True
+    # mark the (empty) content as already read, so iter_content works without a body
+    response._content = b""
+    response._content_consumed = True
+    return response
+
+
+def get_localcache_path(prefix, url):
+    return os.path.join(
+        CACHE_DIR,
+        "{}_{}.json".format(prefix, hashlib.sha1(url.encode("utf-8")).hexdigest()),
+    )
+
+
+def load_from_localcache(prefix, url, response):
+    """
+    Returns the data saved with `save_to_localcache` for `url`, as long as the
+    ETag/Last-Modified of `response` still matches the one it was saved with,
+    or else None.
+    """
+    validator = response.headers.get("etag") or response.headers.get("last-modified")
+    localcache_path = get_localcache_path(prefix, url)
+    if not validator or not os.path.exists(localcache_path):
+        return None
+    with open(localcache_path, "r", encoding="utf-8") as f:
+        localcache = json.load(f)
+    if localcache["validator"] != validator:
+        return None
+    return localcache["data"]
+
+
+def save_to_localcache(prefix, url, response, data):
+    """
+    Save the JSON-serializable `data` derived from the `response` for `url`, so it
+    can be reused on later runs while the page is unchanged.
+    """
+    validator = response.headers.get("etag") or response.headers.get("last-modified")
+    if not validator:
+        return
+    localcache_path = get_localcache_path(prefix, url)
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    # write to a temp file first, so an interrupted run can't leave a partial file
+    with open(localcache_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"validator": validator, "data": data}, f)
+    os.replace(localcache_path + ".tmp", localcache_path)
+
+
+class ZipWriter(object):
+    """
+    Collects the files of an HTML5 app and writes them into a zip file with
+    predictable sort order and metadata, so that the MD5 of the zip stays the
+    same if the same content is zipped twice. Files can be added from several
+    threads at once.
+    """
+
+    def __init__(self):
+        self._files = {}
+        # names of the files whose content is still being read by `add`
+        self._adding = set()
+        self._lock = threading.Lock()
+
+    def add(self, name, content):
+        """
+        Add a file called `name` to the zip, with `content` given either as bytes
+        or as an iterable of byte chunks. Returns the SHA1 hex digest of the content.
+        Raises ValueError if a file called `name` was already added.
+        """
+        with self._lock:
+            if name in self._adding or name in self._files:
+                raise ValueError("A file named {} is already in the zip".format(name))
+            self._adding.add(name)
+        try:
+            if isinstance(content, bytes):
+                content = [content]
+            spool = tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_SIZE)
+            try:
+                sha1 = hashlib.sha1()
+                for chunk in content:
+                    sha1.update(chunk)
+                    spool.write(chunk)
+                spool.seek(0)
+            except Exception:
+                spool.close()
+                raise
+            with self._lock:
+                self._files[name] = spool
+        finally:
+            with self._lock:
+                self._adding.discard(name)
+        return sha1.hexdigest()
+
+    def remove(self, name):
+        with self._lock:
+            removed = self._files.pop(name, None)
+        if removed:
+            removed.close()
+
+    def discard(self):
+        """
+        Drop all the added files, without writing a zip file.
+        """
+        with self._lock:
+            files, self._files = self._files, {}
+        for spool in files.values():
+            spool.close()
+
+    def finalize(self):
+        """
+        Write all the added files into a new zip file, in sorted order.
+        Returns: path (str) to the zip file
+        """
+        zippathfd, zippath = tempfile.mkstemp(suffix=".zip")
+        with os.fdopen(zippathfd, "wb") as f:
+            with zipfile.ZipFile(f, "w") as outputzip:
+                for name in sorted(self._files):
+                    info = zipfile.ZipInfo(name, date_time=ZIP_DATE_TIME)
+                    info.compress_type = zipfile.ZIP_DEFLATED
+                    info.create_system = 0
+                    with self._files[name] as spool:
+                        with outputzip.open(info, "w") as entry:
+                            shutil.copyfileobj(spool, entry, DOWNLOAD_CHUNK_SIZE)
+        self._files = {}
+        return zippath
+
+
+def get_image_filenames(urls):
+    """
+    Pick a distinct filename within the zip for each of the image `urls`. Images
+    are named after the last part of their URL; when several URLs end the same way,
+    all but the first get a suffix derived from their URL, so that the names don't
+    depend on the order in which the downloads finish.
+    """
+    filenames = []
+    # index.html is the page itself, so no image can take that name
+    taken = {"index.html"}
+    for url in urls:
+        _, _, filename = calculate_relative_url(url)
+        if filename in taken:
+            root, ext = os.path.splitext(filename)
+            urlhash = hashlib.sha1(url.encode("utf-8")).hexdigest()[:8]
+            filename = "{}-{}{}".format(root, urlhash, ext)
+        filenames.append(filename)
+        taken.add(filename)
+    return filenames
+
+
+def stream_file(url, filename, zipwriter):
+    """
+    Download the file at `url` straight into `zipwriter` as `filename`, in chunks,
+    without holding the whole response in memory. Returns the SHA1 hex digest of
+    its content, or None if it could not be downloaded (and so wasn't added).
+    """
+    response = make_request(url, stream=True)
+    # always give the connection back to the pool, even if adding to the zip fails,
+    # since with pool_block=True a leaked connection is never replaced
+    try:
+        if response.status_code != 200:
+            # don't put error pages into the zip; they differ from run to run (and
+            # from the responses made up for URLs already known not to exist)
+            return None
+        return zipwriter.add(
+            filename, response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE)
+        )
+    finally:
+        response.close()
 
 
 class LargeWikipediaChef(SushiChef):
@@ -86,75 +348,133 @@ class LargeWikipediaChef(SushiChef):
 
 
 def add_subpages_from_wikipedia_list(topic, list_url):
+    items = get_subpages_from_wikipedia_list(list_url)
+
+    # download the wikipedia pages into HTML5 app nodes, several at a time, since
+    # the work is almost entirely spent waiting on the network
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=DOWNLOAD_WORKERS
+    ) as executor:
+        futures = [
+            executor.submit(
+                download_wikipedia_page, url, thumbnail=thumbnail_url, title=title
+            )
+            for url, thumbnail_url, title in items
+        ]
+
+        # add the downloaded HTML5 app nodes into the topic, in table order
+        for future in futures:
+            topic.add_child(future.result())
+
+
+def get_subpages_from_wikipedia_list(list_url):
+    """
+    Returns a list of (url, thumbnail_url, title) tuples for the subpages listed
+    in the main table of the Wikipedia page at `list_url`. The result is saved
+    alongside the HTTP cache, and reused as long as the page is unchanged.
+    """
+    response = make_request(list_url)
+
+    # if the page is unchanged since the last run, reuse the saved subpages
+    items = load_from_localcache(LISTCACHE_PREFIX, list_url, response)
+    if items is not None:
+        return [tuple(item) for item in items]
+
     # to understand how the following parsing works, look at:
     #   1. the source of the page (e.g. https://en.wikipedia.org/wiki/List_of_citrus_fruits), or inspect in chrome dev tools
-    #   2. the documentation for BeautifulSoup version 4: https://www.crummy.com/software/BeautifulSoup/bs4/doc/
+    #   2. the documentation for selectolax: https://selectolax.readthedocs.io/en/latest/lexbor.html
 
-    # parse the the page into BeautifulSoup format, so we can loop through and manipulate it
-    page = get_parsed_html_from_url(list_url)
+    # the list page is only read, never modified, so parse it with the (much faster)
+    # lexbor parser rather than BeautifulSoup
+    tree = LexborHTMLParser(response.content)
 
     # extract the main table from the page
-    table = page.find(
-        lambda tag: tag.name == "table"
-        and tag.has_attr("class")
-        and "wikitable" in tag["class"]
-    )
+    table = tree.css_first("table.wikitable")
 
-    # loop through all the rows in the table
-    for row in table.find_all("tr"):
+    # collect the (url, thumbnail, title) of each subpage listed in the table
+    items = []
 
-        # extract the columns (cells, really) within the current row
-        columns = row.find_all("td")
+    # loop through all the rows in the table
+    for row in table.css("tr"):
 
         # some rows are empty, so just skip
-        if not columns:
+        if row.css_first("td") is None:
             continue
 
-        # get the link to the subpage
-        header_column = row.find("th")
-        if header_column:
-            link = header_column.find("a")
+        # get the link to the subpage, from the header cell if there is one or else
+        # from the first column
+        header_column = row.css_first("th")
+        if header_column is not None:
+            link = header_column.css_first("a")
         else:
-            link = columns[0].find("a")
+            link = row.css_first("td:first-of-type a")
 
         # some rows don't have links, so skip
-        if not link:
+        if link is None:
             continue
 
         # extract the URL and title for the subpage
-        url = make_fully_qualified_url(link["href"])
-        title = link.text
+        url = make_fully_qualified_url(link.attributes["href"])
+        title = link.text()
 
         # attempt to extract a thumbnail for the subpage, from the second column in the table
-        image = columns[1].find("img")
-        thumbnail_url = make_fully_qualified_url(image["src"]) if image else None
+        image = row.css_first("td:nth-of-type(2) img")
+        thumbnail_url = None
+        if image is not None:
+            thumbnail_url = make_fully_qualified_url(image.attributes["src"])
         if thumbnail_url and not (
             thumbnail_url.endswith("jpg") or thumbnail_url.endswith("png")
         ):
             thumbnail_url = None
 
-        # download the wikipedia page into an HTML5 app node
-        html5app = download_wikipedia_page(url, thumbnail=thumbnail_url, title=title)
+        items.append((url, thumbnail_url, title))
 
-        # add the downloaded HTML5 app node into the topic
-        topic.add_child(html5app)
+    save_to_localcache(LISTCACHE_PREFIX, list_url, response, items)
 
+    return items
 
-def download_wikipedia_page(url, thumbnail, title):
-    # create a temp directory to house our downloaded files
-    destpath = tempfile.mkdtemp()
-
-    # downlod the main wikipedia page, apply a middleware processor, and call it index.html
-    localref, _ = download_file(
-        url,
-        destpath,
-        filename="index.html",
-        middleware_callbacks=process_wikipedia_page,
-        request_fn=make_request,
-    )
 
-    # turn the temp folder into a zip file
-    zippath = create_predictable_zip(destpath)
+def download_wikipedia_page(url, thumbnail, title):
+    # collect the downloaded files straight into a zip, rather than a temp directory
+    zipwriter = ZipWriter()
+
+    # downlod the main wikipedia page
+    response = make_request(url)
+
+    # if the page is unchanged since the last run, reuse the page as rewritten then,
+    # so that it doesn't need to be parsed again, and only fetch the images it uses
+    html = None
+    pagecache = load_from_localcache(PAGECACHE_PREFIX, url, response)
+    if pagecache is not None:
+        image_urls = [image_url for image_url, _ in pagecache["images"]]
+        filenames = [filename for _, filename in pagecache["images"]]
+        if None in download_images(image_urls, filenames, zipwriter):
+            # an image of the cached page can no longer be downloaded, so start over
+            # and rewrite the page so that it doesn't point at a missing file
+            zipwriter.discard()
+        else:
+            html = pagecache["html"].encode("utf-8", "surrogateescape")
+
+    if html is None:
+        html, images, complete = process_wikipedia_page(response.content, zipwriter)
+        # only cache pages whose images were all downloaded, so that the images that
+        # failed are tried again on the next run
+        if complete:
+            save_to_localcache(
+                PAGECACHE_PREFIX,
+                url,
+                response,
+                {
+                    "html": html.decode("utf-8", "surrogateescape"),
+                    "images": images,
+                },
+            )
+
+    # call the rewritten page index.html
+    zipwriter.add("index.html", html)
+
+    # write out the zip file
+    zippath = zipwriter.finalize()
 
     # create an HTML5 app node
     html5app = HTML5AppNode(
@@ -168,16 +488,70 @@ def download_wikipedia_page(url, thumbnail, title):
     return html5app
 
 
-def process_wikipedia_page(content, baseurl, destpath, **kwargs):
-    page = BeautifulSoup(content, "html.parser")
+def get_image_url(match):
+    """
+    Returns the fully qualified URL of the image in an `IMG_SRC_RE` match.
+    """
+    return make_fully_qualified_url(unescape(match.group(2).decode("utf-8")))
 
-    for image in page.find_all("img"):
-        relpath, _ = download_file(
-            make_fully_qualified_url(image["src"]), destpath, request_fn=make_request
-        )
-        image["src"] = relpath
 
-    return str(page)
+def process_wikipedia_page(content, zipwriter):
+    """
+    Download the images of the Wikipedia page `content` (bytes) into `zipwriter`,
+    and point its <img> tags at them. Returns the rewritten page (bytes), the
+    (url, filename) of each image that was kept in the zip, and whether all the
+    images could be downloaded.
+    """
+    # only the src attributes of the images change, so rewrite them in place rather
+    # than parsing the page and serializing the whole tree back out again
+
+    # the same image (icons, flags, spacers) often appears many times on a page,
+    # so only download each distinct URL once
+    image_urls = [get_image_url(match) for match in IMG_SRC_RE.finditer(content)]
+    unique_urls = list(dict.fromkeys(image_urls))
+    filenames = get_image_filenames(unique_urls)
+
+    sha1s = download_images(unique_urls, filenames, zipwriter)
+
+    # different URLs can serve identical content, so keep only the first copy of each
+    relpaths = {}
+    relpaths_by_hash = {}
+    kept_images = []
+    for url, filename, sha1 in zip(unique_urls, filenames, sha1s):
+        # images that couldn't be downloaded keep pointing at their original URL
+        if sha1 is None:
+            continue
+        relpath = "./" + filename
+        first_relpath = relpaths_by_hash.setdefault(sha1, relpath)
+        if first_relpath != relpath:
+            zipwriter.remove(filename)
+        else:
+            kept_images.append((url, filename))
+        relpaths[url] = first_relpath
+
+    def replace_image_src(match):
+        relpath = relpaths.get(get_image_url(match))
+        if relpath is None:
+            return match.group(0)
+        return match.group(1) + escape(relpath).encode("utf-8") + match.group(3)
+
+    complete = None not in sha1s
+    return IMG_SRC_RE.sub(replace_image_src, content), kept_images, complete
+
+
+def download_images(urls, filenames, zipwriter):
+    """
+    Download the images at `urls` into `zipwriter` as `filenames`, in parallel,
+    reusing the pooled connections of `sess`. Returns the results of `stream_file`
+    for each URL.
+    """
+    return list(
+        image_executor.map(
+            lambda url, filename: stream_file(url, filename, zipwriter),
+            urls,
+            filenames,
+        )
+    )
 
 
 if __name__ == "__main__":
@@ -15,7 +15,7 @@ from .classes import nodes
 from .commands import uploadchannel_wrapper
 from .exceptions import InvalidUsageException
 from .exceptions import raise_for_invalid_channel
-from .managers.progress import Status
+from .managers.progress import STEP_NAMES
 from .utils.downloader import get_archive_filename
 from .utils.jsontrees import build_tree_from_json
 from .utils.jsontrees import get_channel_node_from_json
@@ -129,10 +129,9 @@ class SushiChef(object):
             action="store_true",
             help="Resume chef session from a specified step.",
         )
-        allsteps = [step.name.upper() for step in Status]
         parser.add_argument(
             "--step",
-            choices=allsteps,
+            choices=STEP_NAMES,
             default="LAST",
             help="Step to resume progress from (use with the --resume).",
         )
@@ -36,6 +36,10 @@ class Status(Enum):
     LAST = 10
 
 
+# names of all the steps, in order (Status names are already upper case)
+STEP_NAMES = tuple(status.name for status in Status)
+
+
 class RestoreManager:
     """Manager for handling resuming rice cooking process
 
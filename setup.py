@@ -21,6 +21,7 @@ requirements = [
     "selenium==3.0.1",
     "youtube-dl>=2020.6.16.1",
     "html5lib",
+    "lxml",
     "cachecontrol==0.12.0",
     "lockfile==0.12.2",  # TODO: check if this is necessary
     "css-html-js-minify==2.2.2",
@@ -38,6 +39,11 @@ requirements = [
     "EbookLib>=0.17.1",
 ]
 
+extras_requirements = {
+    # dependencies only used by the chefs in examples/
+    "examples": ["selectolax"],
+}
+
 
 setup(
     name="ricecooker",
@@ -58,6 +64,7 @@ setup(
     },
     include_package_data=True,
     install_requires=requirements,
+    extras_require=extras_requirements,
     license="MIT license",
     zip_safe=False,
     keywords="ricecooker",